@@ -2,15 +2,115 @@ from __future__ import annotations
 import os
 import json
 import shutil
+import socket
+import time
 from datetime import date
 from pathlib import Path
 import subprocess
 from typing import Literal
 
-from .utils import GlobalConfigs, confirm_continue
+from .utils import (
+    GlobalConfigs,
+    confirm_continue,
+    copy_file,
+    file_checksum,
+    files_differ,
+    tree_size,
+    write_text_atomic,
+)
 
 GLOBAL = GlobalConfigs()
 
+COMPLETION_SCRIPT = """# generated by `dubby sync-completions`, changes will be overwritten
+if [ -n "$ZSH_VERSION" ]; then
+    autoload -U +X bashcompinit && bashcompinit
+fi
+
+_dubby_complete() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}"
+    local prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    local cache="{cache_dir}"
+    local option="" words="" source="names" i
+
+    # --tags and --exclude take any number of values, so look back for the
+    # last option used
+    for (( i=COMP_CWORD-1; i>0; i-- )); do
+        if [[ "${{COMP_WORDS[i]}}" == -* ]]; then
+            option="${{COMP_WORDS[i]}}"
+            break
+        fi
+    done
+
+    if [[ "$cur" == -* ]]; then
+        source=""
+        words="{options}"
+    elif [[ "$prev" == "-o" || "$prev" == "--org" ]]; then
+        source="orgs"
+    elif [[ "$prev" == "-s" || "$prev" == "--status" ]]; then
+        source="statuses"
+    elif [[ "$prev" == "-f" || "$prev" == "--file" || "$prev" == "--target" || "$option" == "--exclude" ]]; then
+        compopt -o filenames 2>/dev/null
+        COMPREPLY=( $(compgen -f -- "$cur") )
+        return
+    elif [[ "$option" == "-t" || "$option" == "--tags" ]]; then
+        source="tags"
+    elif [[ "$COMP_CWORD" -eq 1 ]]; then
+        source=""
+        words="{operations}"
+    fi
+
+    if [[ -n "$source" && -f "$cache/$source" ]]; then
+        words="$(<"$cache/$source")"
+    fi
+    COMPREPLY=( $(compgen -W "$words" -- "$cur") )
+}}
+complete -F _dubby_complete dubby
+"""
+
+
+def update_completion_cache(entries: dict):
+    """Updates the shell completion cache with the given {name: manifest data}
+    entries, where None as the data removes that project. If no cache exists
+    yet it is built from the full registry instead."""
+    index_path = Path(GLOBAL.paths["completions-dir"], "index.json")
+    if not index_path.is_file():
+        Registry().sync_completions()
+        return
+
+    with open(index_path, "r") as o:
+        index = json.load(o)
+    for name, data in entries.items():
+        if data is None:
+            index.pop(name, None)
+        else:
+            index[name] = {
+                "status": data["status"],
+                "org": data["org"],
+                "tags": data["tags"],
+            }
+    write_completion_cache(index)
+
+
+def write_completion_cache(index: dict):
+    """Writes the completion index and the plain text word lists that the
+    completion script reads, one word per line."""
+    cache_dir = Path(GLOBAL.paths["completions-dir"])
+    cache_dir.mkdir(exist_ok=True)
+
+    names = sorted(index.keys(), key=str.lower)
+    tags = sorted(set(t for i in index.values() for t in i["tags"]))
+    orgs = sorted(set(i["org"] for i in index.values() if i["org"]))
+    statuses = ["active", "inactive", "archived"]
+
+    for filename, words in [
+        ("names", names),
+        ("tags", tags),
+        ("orgs", orgs),
+        ("statuses", statuses),
+    ]:
+        write_text_atomic(Path(cache_dir, filename), "".join(f"{w}\n" for w in words))
+    write_text_atomic(Path(cache_dir, "index.json"), json.dumps(index, indent=1))
+
 
 class Project:
 
@@ -161,21 +261,52 @@ class Project:
                 d_link.unlink()
             d_link.symlink_to(d_proj)
 
-    def copy_notes_to_dropbox(self):
+    def copy_notes_to_dropbox(self, checksum: bool = False):
+        """Mirrors the local Notes directory (markdown pages and assets) into
+        Dropbox. Only files that differ from the existing copy are written, and
+        files that no longer exist locally are removed from Dropbox."""
+        local_project_notes = Path(self.local_path, "Notes")
+        # with no Notes directory every Dropbox copy would look stale
+        if not local_project_notes.is_dir():
+            print(f"[WARNING] No Notes directory, skipping: {local_project_notes}")
+            return
+
         dbox_notes_path = Path(GLOBAL.paths["legion"], "project-notes")
         dbox_notes_path.mkdir(exist_ok=True)
 
         dbox_project_notes_dir = Path(dbox_notes_path, self.name)
         dbox_project_notes_dir.mkdir(exist_ok=True)
 
-        local_project_notes = Path(self.local_path, "Notes")
+        sources = {}
         for md_file in local_project_notes.glob("*.md"):
-            shutil.copy(md_file, Path(dbox_project_notes_dir, md_file.name))
+            if md_file.is_file():
+                sources[Path(md_file.name)] = md_file
         assets_dir = Path(local_project_notes, "assets")
         if assets_dir.is_dir():
-            shutil.copytree(
-                assets_dir, Path(dbox_project_notes_dir, "assets"), dirs_exist_ok=True
-            )
+            for asset in assets_dir.rglob("*"):
+                if asset.is_file():
+                    sources[asset.relative_to(local_project_notes)] = asset
+
+        copied = 0
+        for rel_path, src in sources.items():
+            dst = Path(dbox_project_notes_dir, rel_path)
+            if not files_differ(src, dst, checksum=checksum):
+                continue
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            copy_file(src, dst)
+            copied += 1
+
+        # remove stale files, children sort after parents so go in reverse
+        removed = 0
+        for dst in sorted(dbox_project_notes_dir.rglob("*"), reverse=True):
+            if dst.is_dir() and not dst.is_symlink():
+                if not any(dst.iterdir()):
+                    dst.rmdir()
+            elif dst.relative_to(dbox_project_notes_dir) not in sources:
+                dst.unlink()
+                removed += 1
+
+        print(f"notes copied: {copied}, removed: {removed}")
 
     def set_status_symlink(self, remove=False):
         stati = ["active", "inactive", "archived"]
@@ -242,7 +373,8 @@ class Project:
         archive_name = date.today().strftime(f"{self.name}___%Y-%m-%d.tar.gz")
         archive_path = Path(target, archive_name)
 
-        cmd = ["tar", "-C", str(self.local_path.parent)]
+        # don't let reading .workon count as using the project (see get_last_used)
+        cmd = ["tar", "--atime-preserve", "-C", str(self.local_path.parent)]
 
         exclusions = [
             "Notes",
@@ -260,11 +392,79 @@ class Project:
 
         cmd += ["-czf", str(archive_path), self.local_path.name]
 
-        subprocess.call(cmd)
+        if subprocess.call(cmd) != 0 or not archive_path.is_file():
+            raise Exception(f"Unable to create archive: {archive_path}")
+        ArchiveCatalog().add_entry(self.name, archive_path)
+
+        return archive_path
+
+    def get_last_used(self) -> float:
+        """Returns a timestamp for the last time this project was used locally,
+        taken from the access time of the .workon script, which is touched by
+        the workon alias and by mark_used(). Directory times aren't used as
+        relinking Notes and Dropbox changes them."""
+        workon_path = Path(self.local_path, ".workon")
+        if workon_path.is_file():
+            return workon_path.stat().st_atime
+        return 0
+
+    def mark_used(self):
+        workon_path = Path(self.local_path, ".workon")
+        if workon_path.is_file():
+            os.utime(workon_path, ns=(time.time_ns(), workon_path.stat().st_mtime_ns))
+
+    def evict(self) -> Path:
+        """Archives the full local directory and removes it, so that restore()
+        can bring it back exactly. Unlike backup() nothing is excluded except
+        the Notes and Dropbox links at the top level, which initialize_local()
+        regenerates. The directory is only removed once tar has succeeded and
+        the archive has been read back. Archives go to the evicted-archives
+        path (archive-dir by default) rather than projects-local."""
+        archive_name = date.today().strftime(f"{self.name}___%Y-%m-%d.tar.gz")
+        archive_dir = Path(GLOBAL.paths["evicted-archives"])
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        archive_path = Path(archive_dir, archive_name)
+        tmp_path = Path(archive_path.parent, f".{archive_name}.tmp")
+
+        cmd = ["tar", "-C", str(self.local_path.parent), "--anchored", "--no-wildcards"]
 
+        dropbox_link = Path(self.local_path, "Dropbox")
+        if dropbox_link.is_symlink():
+            cmd += ["--exclude", f"{self.local_path.name}/Dropbox"]
+        notes_dir = Path(self.local_path, "Notes")
+        if notes_dir.is_dir() and all(
+            i.is_symlink() or i.is_dir() for i in notes_dir.rglob("*")
+        ):
+            cmd += ["--exclude", f"{self.local_path.name}/Notes"]
+
+        cmd += ["-czf", str(tmp_path), self.local_path.name]
+
+        verify_cmd = ["tar", "-tzf", str(tmp_path)]
+        if (
+            subprocess.call(cmd) != 0
+            or subprocess.call(verify_cmd, stdout=subprocess.DEVNULL) != 0
+        ):
+            if tmp_path.is_file():
+                os.remove(tmp_path)
+            raise Exception(f"Unable to archive, local directory retained: {self.local_path}")
+        os.replace(tmp_path, archive_path)
+        ArchiveCatalog().add_entry(self.name, archive_path, evicted=True)
+
+        self.set_status_symlink(remove=True)
+        shutil.rmtree(self.local_path)
+        self.is_local = False
         return archive_path
 
-    def save_manifest(self):
+    def restore(self, archive_path: Path):
+        """Extracts an archive made by backup() or evict() back into
+        projects-local."""
+        cmd = ["tar", "-C", str(self.local_path.parent), "-xzf", str(archive_path)]
+        if subprocess.call(cmd) != 0:
+            raise Exception(f"Unable to extract archive: {archive_path}")
+        self.is_local = self.local_path.is_dir()
+        ArchiveCatalog().set_evicted(archive_path, False)
+
+    def save_manifest(self, refresh_completions: bool = True):
         manifest_dir = Path(GLOBAL.paths["registry-dir"])
         manifest_dir.mkdir(parents=True, exist_ok=True)
         data = self.serialize()
@@ -273,6 +473,9 @@ class Project:
         with open(man_path, "w") as o:
             json.dump(data, o, indent=2)
 
+        if refresh_completions:
+            update_completion_cache({self.name: data})
+
 
 class Registry:
 
@@ -375,9 +578,97 @@ class Registry:
                 "Delete project manifest? This will completely remove the project from the registry, though local directories may exist on other systems."
             ):
                 os.remove(Path(GLOBAL.paths["registry-dir"], name + ".json"))
+                update_completion_cache({name: None})
         else:
             print("no matching project to delete.")
 
+    def export_projects(self, stream, **filters) -> int:
+        """Writes one JSON object per line to stream for every project in the
+        registry (optionally filtered, see get_projects)."""
+        count = 0
+        for project in self.get_projects(**filters):
+            stream.write(json.dumps({"name": project.name, **project.serialize()}) + "\n")
+            count += 1
+        return count
+
+    def import_projects(self, stream, initialize: bool = False) -> "list[Project]":
+        """Reads JSON lines from stream (as written by export_projects) and adds
+        each entry to the registry. All lines are validated before any manifest
+        is written, projects that already exist are skipped, and aliases are
+        regenerated once at the end rather than once per project."""
+
+        existing = set(
+            i.stem for i in Path(GLOBAL.paths["registry-dir"]).glob("*.json")
+        )
+        fields = {"name", "status", "org", "tags", "tagline", "description"}
+
+        entries = []
+        errors = []
+        for n, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                errors.append(f"line {n}: invalid json ({e})")
+                continue
+            if not isinstance(entry, dict):
+                errors.append(f"line {n}: expected an object")
+                continue
+            name = entry.get("name")
+            if (
+                not isinstance(name, str)
+                or not name
+                or name.startswith(".")
+                or "/" in name
+                or "\0" in name
+            ):
+                errors.append(f"line {n}: invalid name: {name!r}")
+                continue
+            unknown = set(entry.keys()) - fields
+            if unknown:
+                errors.append(f"line {n}: unknown fields: {', '.join(sorted(unknown))}")
+                continue
+            if entry.get("status", "active") not in ["active", "inactive", "archived"]:
+                errors.append(f"line {n}: invalid status: {entry['status']}")
+                continue
+            tags = entry.get("tags", [])
+            if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags):
+                errors.append(f"line {n}: tags must be a list of strings")
+                continue
+            invalid = [
+                i for i in ["org", "tagline", "description"]
+                if not isinstance(entry.get(i), (str, type(None)))
+            ]
+            if invalid:
+                errors.append(f"line {n}: must be a string or null: {', '.join(invalid)}")
+                continue
+            if name in existing:
+                print(f"[WARNING] project already exists, skipping: {name}")
+                continue
+            if "org" not in entry and "__" in name:
+                entry["org"] = name.split("__")[0]
+            existing.add(name)
+            entries.append(entry)
+
+        if errors:
+            for e in errors:
+                print(f"[ERROR] {e}")
+            raise Exception(f"{len(errors)} invalid entries, nothing imported")
+
+        projects = [Project(**entry) for entry in entries]
+        for project in projects:
+            project.save_manifest(refresh_completions=False)
+        update_completion_cache({p.name: p.serialize() for p in projects})
+
+        if initialize:
+            for project in projects:
+                project.initialize_local()
+
+        self.sync_aliases()
+        return projects
+
     def sync_aliases(self):
         alias_file_path = GLOBAL.paths["aliases_file"]
         lines = []
@@ -393,15 +684,36 @@ class Registry:
 
         # now create the list of auto-generated aliases from project directories
         # prepopulate the list with the main alias for this file
+        dubby_path = Path(Path(__file__).parent.parent.resolve(), "dubby.py")
         aliases = [
-            f"alias dubby='{Path(Path(__file__).parent.parent.resolve(), 'dubby.py')}'\n"
+            f"alias dubby='{dubby_path}'\n"
         ]
-        for project in self.get_projects(local=True):
+        local_projects = self.get_projects(local=True)
+        for project in local_projects:
             workon_path = Path(project.local_path, ".workon")
             name = project.name.replace(" ", "-").replace("'", "")
-            aliases.append(f"alias workon-{name}='source \"{workon_path}\"'\n")
+            aliases.append(
+                f"alias workon-{name}='touch -a \"{workon_path}\" && source \"{workon_path}\"'\n"
+            )
             aliases.append(f"alias edit-workon-{name}='nano \"{workon_path}\"'\n")
 
+        # evicted projects get a workon alias that restores them first
+        local_names = set(p.name for p in local_projects)
+        evicted = set(i["project"] for i in ArchiveCatalog().get_evicted())
+        for project_name in sorted(evicted - local_names):
+            project = self.get_project(project_name)
+            if project is None:
+                continue
+            workon_path = Path(project.local_path, ".workon")
+            name = project.name.replace(" ", "-").replace("'", "")
+            aliases.append(
+                f"alias workon-{name}='\"{dubby_path}\" add \"{project.name}\" && source \"{workon_path}\"'\n"
+            )
+
+        completions_file = GLOBAL.paths["completions_file"]
+        if completions_file.is_file():
+            aliases.append(f". \"{completions_file}\"\n")
+
         # ~~ AUTO-GENERATED ALIASES BELOW ~~
         with open(alias_file_path, "w") as op:
             op.writelines(lines)
@@ -410,6 +722,52 @@ class Registry:
 
         print("bash aliases updated. run:\n  source ~/.bashrc")
 
+    def sync_completions(self, operations: "list[str]" = None, options: "list[str]" = None):
+        """Rebuilds the completion cache from every manifest in the registry
+        and, if operations are given, rewrites the bash/zsh completion script
+        that reads from it."""
+        index = {}
+        for project in self.get_projects():
+            index[project.name] = {
+                "status": project.status,
+                "org": project.org,
+                "tags": sorted(project.tags),
+            }
+        write_completion_cache(index)
+
+        if operations:
+            script = COMPLETION_SCRIPT.format(
+                cache_dir=GLOBAL.paths["completions-dir"],
+                operations=" ".join(operations),
+                options=" ".join(options or []),
+            )
+            write_text_atomic(GLOBAL.paths["completions_file"], script)
+            print(f"completion script written: {GLOBAL.paths['completions_file']}")
+
+    def get_eviction_candidates(self, quota: int) -> "tuple[int, int, list[Project]]":
+        """Returns the total size of all local project directories, the size
+        that would remain after eviction, and the inactive and archived projects
+        that would need to be evicted, least recently used first, to bring that
+        total within quota (or as close to it as possible)."""
+        projects = self.get_projects(local=True)
+        last_used = {p.name: p.get_last_used() for p in projects}
+        sizes = {p.name: tree_size(p.local_path) for p in projects}
+        total = sum(sizes.values())
+
+        candidates = sorted(
+            [p for p in projects if p.status in ["inactive", "archived"]],
+            key=lambda p: last_used[p.name],
+        )
+        to_evict = []
+        remaining = total
+        for project in candidates:
+            if remaining <= quota:
+                break
+            to_evict.append(project)
+            remaining -= sizes[project.name]
+
+        return total, remaining, to_evict
+
     def get_all_tags(self) -> list[str]:
 
         all_tags = set()
@@ -418,3 +776,146 @@ class Registry:
                 all_tags.add(tag)
 
         return sorted(list(all_tags))
+
+
+class ArchiveCatalog:
+    """Inventory of the backup archives created by Project.backup(), kept as
+    JSON lines in the archive-dir so that it is shared across hosts. Each host
+    only ever writes its own catalog-<host>.jsonl file, so concurrent backups on
+    different hosts can't produce Dropbox conflicts, and entries record the host
+    they belong to, as archive locations are host paths."""
+
+    def __init__(self):
+        self.host = socket.gethostname()
+        self.path = Path(GLOBAL.paths["archive-dir"], f"catalog-{self.host}.jsonl")
+
+    def get_entries(self, name: str = None, host: str = None) -> "list[dict]":
+        if host:
+            paths = [Path(GLOBAL.paths["archive-dir"], f"catalog-{host}.jsonl")]
+        else:
+            paths = Path(GLOBAL.paths["archive-dir"]).glob("catalog-*.jsonl")
+
+        entries = []
+        for path in paths:
+            if path.is_file():
+                with open(path, "r") as o:
+                    for line in o:
+                        if line.strip():
+                            entries.append(json.loads(line))
+        if name:
+            entries = [i for i in entries if i["project"] == name]
+        if host:
+            entries = [i for i in entries if i["host"] == host]
+        return sorted(entries, key=lambda i: (i["project"].lower(), i["date"]))
+
+    def get_latest(self, name: str, evicted: bool = False) -> dict:
+        """Returns the most recent archive for this project on this host whose
+        file still exists, or None. With evicted=True only archives made by
+        Project.evict() are considered."""
+        for entry in reversed(self.get_entries(name=name, host=self.host)):
+            if evicted and not entry.get("evicted"):
+                continue
+            if Path(entry["location"]).is_file():
+                return entry
+        return None
+
+    def add_entry(self, name: str, archive_path: Path, evicted: bool = False) -> dict:
+        archive_path = Path(archive_path).resolve()
+        entry = {
+            "project": name,
+            "date": date.today().isoformat(),
+            "size": archive_path.stat().st_size,
+            "checksum": file_checksum(archive_path),
+            "location": str(archive_path),
+            "host": self.host,
+        }
+        if evicted:
+            entry["evicted"] = True
+        # a backup made twice in one day overwrites the same file
+        entries = [
+            i for i in self.get_entries(host=self.host)
+            if i["location"] != entry["location"]
+        ]
+        entries.append(entry)
+        self.save_entries(entries)
+        return entry
+
+    def get_evicted(self, name: str = None) -> "list[dict]":
+        """Returns this host's archives that were made when evicting a project
+        from local disk, and are therefore the copy to restore it from."""
+        return [i for i in self.get_entries(name=name, host=self.host) if i.get("evicted")]
+
+    def set_evicted(self, archive_path: Path, evicted: bool) -> bool:
+        """Flags the catalog entry for this archive, returning False if there
+        is no such entry (e.g. because the backup failed)."""
+        location = str(Path(archive_path).resolve())
+        entries = self.get_entries(host=self.host)
+        found = False
+        for entry in entries:
+            if entry["location"] == location:
+                entry["evicted"] = evicted
+                found = True
+        if found:
+            self.save_entries(entries)
+        return found
+
+    def save_entries(self, entries: "list[dict]"):
+        """Rewrites this host's catalog file with entries, which must all
+        belong to this host."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_text_atomic(self.path, "".join(json.dumps(i) + "\n" for i in entries))
+
+    def get_expired(
+        self,
+        name: str = None,
+        keep_last: int = 0,
+        keep_daily: int = 0,
+        keep_monthly: int = 0,
+    ) -> "list[dict]":
+        """Applies the retention policy to this host's archives, per project,
+        and returns the entries that fall outside of it. An archive is kept if
+        it is one of the last N, the newest of one of the last N days that have
+        archives, or the newest of one of the last N months that have archives.
+        Archives made by Project.evict() are always kept, as they are the only
+        full copy of a project that is no longer on local disk."""
+        if not any([keep_last, keep_daily, keep_monthly]):
+            raise Exception("A retention policy requires at least one keep value")
+
+        by_project = {}
+        for entry in self.get_entries(name=name, host=self.host):
+            if entry.get("evicted"):
+                continue
+            by_project.setdefault(entry["project"], []).append(entry)
+
+        expired = []
+        for entries in by_project.values():
+            # entries are sorted by date and then catalog (insertion) order, so
+            # reversing puts the newest first, including within the same day
+            entries = list(reversed(entries))
+            keep = set(range(min(keep_last, len(entries))))
+            days, months = [], []
+            for n, entry in enumerate(entries):
+                day, month = entry["date"], entry["date"][:7]
+                if day not in days and len(days) < keep_daily:
+                    days.append(day)
+                    keep.add(n)
+                if month not in months and len(months) < keep_monthly:
+                    months.append(month)
+                    keep.add(n)
+            expired += [i for n, i in enumerate(entries) if n not in keep]
+
+        return expired
+
+    def remove_entries(self, entries: "list[dict]"):
+        """Deletes the archive files for these entries and drops them from this
+        host's catalog in a single rewrite. Entries from other hosts are left
+        for those hosts to prune."""
+        to_remove = set(i["location"] for i in entries if i["host"] == self.host)
+        for location in to_remove:
+            archive_path = Path(location)
+            if archive_path.is_file():
+                os.remove(archive_path)
+        remaining = [
+            i for i in self.get_entries(host=self.host) if i["location"] not in to_remove
+        ]
+        self.save_entries(remaining)
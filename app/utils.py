@@ -1,4 +1,7 @@
+import os
 import json
+import shutil
+import hashlib
 from pathlib import Path
 
 
@@ -28,6 +31,108 @@ def print_table(table):
         print(row_format.format(*row))
 
 
+def format_size(size: int) -> str:
+    """Formats a byte count for display, e.g. 1536 -> 1.5K."""
+    for unit in ["B", "K", "M", "G", "T"]:
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+
+
+def parse_size(size: str) -> int:
+    """Parses a size like 500M or 50G (or a plain byte count) into bytes."""
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def tree_size(path: Path) -> int:
+    """Returns the total size in bytes of all files below path, without
+    following symlinks."""
+    total = 0
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def file_checksum(path: Path) -> str:
+    """Returns the sha256 hex digest of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as o:
+        for chunk in iter(lambda: o.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def files_differ(src: Path, dst: Path, checksum: bool = False) -> bool:
+    """Compares src against an existing copy at dst using size and mtime, or
+    file contents if checksum is True."""
+    if not dst.is_file():
+        return True
+    src_stat, dst_stat = src.stat(), dst.stat()
+    if src_stat.st_size != dst_stat.st_size:
+        return True
+    if checksum:
+        return file_checksum(src) != file_checksum(dst)
+    return int(src_stat.st_mtime) != int(dst_stat.st_mtime)
+
+
+def copy_file(src: Path, dst: Path):
+    """Copies src to dst, letting the kernel move the bytes with copy_file_range
+    or sendfile where available and falling back to a regular read/write copy.
+    The source mtime is carried over so later comparisons can skip the file."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        offset = 0
+
+        if offset < size and hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(infd, outfd, size - offset, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass
+
+        if offset < size and hasattr(os, "sendfile"):
+            try:
+                os.lseek(outfd, offset, os.SEEK_SET)
+                while offset < size:
+                    sent = os.sendfile(outfd, infd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                pass
+
+        if offset < size:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            shutil.copyfileobj(fsrc, fdst)
+
+    src_stat = os.stat(src)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+
+def write_text_atomic(path: Path, content: str):
+    """Writes content to a temporary file beside path and then moves it into
+    place, so readers never see a partially written file."""
+    tmp_path = Path(path.parent, f".{path.name}.tmp")
+    tmp_path.write_text(content)
+    os.replace(tmp_path, path)
+
+
 class GlobalConfigs:
     def __init__(self):
 
@@ -39,10 +144,21 @@ class GlobalConfigs:
             with open(configs_local_path, "r") as o:
                 configs_local = json.load(o)
             configs['paths'].update(configs_local['paths'])
+            if "local-quota" in configs_local:
+                configs["local-quota"] = configs_local["local-quota"]
+
+        ## optional disk budget for projects-local, e.g. "50G"
+        self.local_quota = configs.get("local-quota")
 
         self.paths = {i: Path(configs["paths"][i]).expanduser() for i in configs["paths"]}
 
         ## set some more paths that are derived from base configs
         self.paths["registry-dir"] = Path(self.paths["projects-dropbox"], ".registry")
         self.paths["archive-dir"] = Path(self.paths["projects-dropbox"], ".archive")
+        ## where enforce-quota puts evicted projects, kept out of projects-local
+        ## so that eviction actually frees space under the quota
+        if "evicted-archives" not in self.paths:
+            self.paths["evicted-archives"] = self.paths["archive-dir"]
         self.paths["aliases_file"] = Path(Path(__file__).parent.parent, ".bash_aliases")
+        self.paths["completions-dir"] = Path(Path(__file__).parent.parent, ".completions")
+        self.paths["completions_file"] = Path(Path(__file__).parent.parent, ".bash_completion")
@@ -1,36 +1,71 @@
 #! /usr/bin/python3
 
+import sys
 import json
 import shutil
 import argparse
-
-from app.models import Registry
-from app.utils import confirm_continue, print_table
+from pathlib import Path
+
+from app.models import GLOBAL, ArchiveCatalog, Registry
+from app.utils import confirm_continue, format_size, parse_size, print_table
+
+OPERATIONS = [
+    "list",
+    "info",
+    "sync-aliases",
+    "sync-symlinks",
+    "sync-notes",
+    "copy-notes",
+    "create",
+    "add",
+    "remove",
+    "backup",
+    "set-active",
+    "set-inactive",
+    "set-archived",
+    "set-description",
+    "set-tagline",
+    "add-tags",
+    "remove-tags",
+    "list-orgs",
+    "list-tags",
+    "export",
+    "import",
+    "sync-completions",
+    "archives",
+    "prune-archives",
+    "enforce-quota",
+]
+
+## offered by the shell completion script, keep in sync with the arguments below
+OPTIONS = [
+    "--help",
+    "--tags",
+    "--description",
+    "--tagline",
+    "--status",
+    "--org",
+    "--local",
+    "--initialize",
+    "--no-tagline",
+    "--verbose",
+    "--exclude",
+    "--no-input",
+    "--checksum",
+    "--file",
+    "--target",
+    "--quota",
+    "--latest",
+    "--keep-last",
+    "--keep-daily",
+    "--keep-monthly",
+]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "operation",
-        choices=[
-            "list",
-            "info",
-            "sync-aliases",
-            "sync-symlinks",
-            "sync-notes",
-            "create",
-            "add",
-            "remove",
-            "backup",
-            "set-active",
-            "set-inactive",
-            "set-archived",
-            "set-description",
-            "set-tagline",
-            "add-tags",
-            "remove-tags",
-            "list-orgs",
-            "list-tags",
-        ],
+        choices=OPERATIONS,
     )
     parser.add_argument(
         "name",
@@ -66,6 +101,12 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--initialize",
+        action="store_true",
+        default=False,
+        help="during import, initialize local directories for the imported projects",
+    )
     parser.add_argument(
         "--no-tagline",
         action="store_true",
@@ -88,26 +129,67 @@ if __name__ == "__main__":
         action="store_true",
         help="use cli arguments to create a project, don't use interactive input",
     )
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        default=False,
+        help="during copy-notes, compare file contents instead of size and mtime",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="JSONL file to export the registry to or import it from, defaults to stdout/stdin",
+    )
     parser.add_argument(
         "--target",
         help="path to external Projects directory to send archive to"
     )
+    parser.add_argument(
+        "--quota",
+        help="during enforce-quota, disk budget for local projects, e.g. 50G (overrides local-quota in configs)",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        default=False,
+        help="when listing archives, only the most recent one per project on this host",
+    )
+    parser.add_argument(
+        "--keep-last",
+        type=int,
+        default=0,
+        help="during prune-archives, keep this many of the most recent archives per project",
+    )
+    parser.add_argument(
+        "--keep-daily",
+        type=int,
+        default=0,
+        help="during prune-archives, keep the newest archive for this many days per project",
+    )
+    parser.add_argument(
+        "--keep-monthly",
+        type=int,
+        default=0,
+        help="during prune-archives, keep the newest archive for this many months per project",
+    )
     args = parser.parse_args()
 
     registry = Registry()
 
     o = args.operation
 
-    print(f"operation: {o}")
-    if args.name:
-        print(f"project: {args.name}")
+    ## keep stdout clean when the registry is being streamed to it
+    if not (o == "export" and not args.file):
+        print(f"operation: {o}")
+        if args.name:
+            print(f"project: {args.name}")
 
-    print(25 * "-")
+        print(25 * "-")
 
     ## because most operations are undertaken on a project, just find it now and use
-    ## it later.
+    ## it later. archives may outlive the project's manifest, so skip those.
     project = None
-    if args.name and o != "create":
+    if args.name and o not in ["create", "archives", "prune-archives"]:
         project = registry.get_project(args.name)
         if project is None:
             print("No project found by that name.")
@@ -170,8 +252,15 @@ if __name__ == "__main__":
             )
             exit()
 
+        if not project.is_local:
+            entry = ArchiveCatalog().get_latest(project.name, evicted=True)
+            if entry:
+                print(f"restoring from archive: {entry['location']}")
+                project.restore(entry["location"])
+
         project.initialize_local()
         project.sync_symlinks()
+        project.mark_used()
         registry.sync_aliases()
 
     elif o == "remove":
@@ -238,6 +327,10 @@ if __name__ == "__main__":
     elif o == "sync-aliases":
         registry.sync_aliases()
 
+    elif o == "sync-completions":
+        registry.sync_completions(operations=OPERATIONS, options=OPTIONS)
+        registry.sync_aliases()
+
     elif o == "sync-symlinks":
         if project:
             if project.is_local:
@@ -260,6 +353,17 @@ if __name__ == "__main__":
                 print(p.name)
                 p.sync_logseq_notes()
 
+    elif o == "copy-notes":
+        if project:
+            if project.is_local:
+                project.copy_notes_to_dropbox(checksum=args.checksum)
+            else:
+                print("[WARNING] This project doesn't exist locally.")
+        else:
+            for p in registry.get_projects(org=args.org, local=True):
+                print(p.name)
+                p.copy_notes_to_dropbox(checksum=args.checksum)
+
     elif o == "set-active":
         project.set_status("active")
 
@@ -283,5 +387,87 @@ if __name__ == "__main__":
     elif o == "set-tagline":
         project.set_tagline(args.tagline)
 
+    elif o == "archives":
+        table_rows = [["PROJECT", "DATE", "SIZE", "HOST", "LOCATION"]]
+        catalog = ArchiveCatalog()
+        entries = catalog.get_entries(name=args.name)
+        if args.latest:
+            names = sorted(set(i["project"] for i in entries), key=str.lower)
+            entries = [i for i in [catalog.get_latest(n) for n in names] if i]
+        for i in entries:
+            table_rows.append(
+                [i["project"], i["date"], format_size(i["size"]), i["host"], i["location"]]
+            )
+
+        print_table(table_rows)
+        print(f"---\ncount: {len(entries)}")
+
+    elif o == "prune-archives":
+        if not any([args.keep_last, args.keep_daily, args.keep_monthly]):
+            print("use --keep-last, --keep-daily, and/or --keep-monthly to set a retention policy.")
+            exit()
+        catalog = ArchiveCatalog()
+        expired = catalog.get_expired(
+            name=args.name,
+            keep_last=args.keep_last,
+            keep_daily=args.keep_daily,
+            keep_monthly=args.keep_monthly,
+        )
+        if not expired:
+            print("no archives to remove.")
+            exit()
+        print("archives outside of the retention policy:")
+        for i in expired:
+            print(f"  {i['location']} ({format_size(i['size'])})")
+        if confirm_continue(f"Delete these {len(expired)} archives?", default=False):
+            catalog.remove_entries(expired)
+            print(f"archives removed: {len(expired)}")
+
+    elif o == "enforce-quota":
+        quota = args.quota if args.quota else GLOBAL.local_quota
+        if not quota:
+            print("set a disk budget with --quota or local-quota in configs.local.json.")
+            exit()
+        quota = parse_size(quota)
+        total, remaining, to_evict = registry.get_eviction_candidates(quota)
+        print(f"local projects: {format_size(total)} of {format_size(quota)}")
+        if total <= quota:
+            exit()
+        if not to_evict:
+            print("[WARNING] over quota, but there are no inactive or archived projects to evict.")
+            exit()
+        print("least recently used projects to evict:")
+        for p in to_evict:
+            print(f"  {p.name} ({p.status})")
+        if remaining > quota:
+            print(
+                f"[WARNING] evicting all of these still leaves {format_size(remaining)}, over quota."
+            )
+        if confirm_continue(f"Archive and remove these {len(to_evict)} local directories?", default=False):
+            for p in to_evict:
+                try:
+                    archive_path = p.evict()
+                    print(f"{p.name} evicted to: {archive_path}")
+                except Exception as e:
+                    print(f"[ERROR] {e}")
+            registry.sync_aliases()
+
+    elif o == "export":
+        filters = {"tags": args.tags, "status": args.status, "local": args.local, "org": args.org}
+        if args.file:
+            with open(args.file, "w") as op:
+                count = registry.export_projects(op, **filters)
+            print(f"---\ncount: {count}")
+        else:
+            registry.export_projects(sys.stdout, **filters)
+
+    elif o == "import":
+        if args.file:
+            with open(args.file, "r") as op:
+                projects = registry.import_projects(op, initialize=args.initialize)
+        else:
+            projects = registry.import_projects(sys.stdin, initialize=args.initialize)
+        print(f"---\nimported: {len(projects)}")
+
     else:
         print("[ERROR] unsupported operation")